@@ -1,11 +1,23 @@
 import streamlit as st
-import google.generativeai as genai
-from pypdf import PdfReader
-from Bio import Entrez
-from docx import Document
 from PIL import Image
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import io
+import json
+import math
+import os
+import random
+import re
+import threading
 import time
+import xml.etree.ElementTree as ET
+import zipfile
+from pathlib import PurePath
+from string import Template
+
+# google.generativeai / fitz / pypdf / lxml / requests 改在用到的函式內才匯入，
+# 冷啟動時側邊欄不必等這些套件載入 (之後由 Python 的模組快取重用)
 
 # --- 1. 頁面設定 ---
 st.set_page_config(page_title="AI 醫學期刊審稿助手 (雙語+精確定位)", layout="wide")
@@ -23,25 +35,135 @@ with st.sidebar:
     2. **精確定位**：標示章節 (Introduction...) 與行號或引用句。
     """)
 
-Entrez.email = email_address
+EUTILS_BASE = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+# 有 NCBI API Key 時速率上限由 3 提升到 10 req/s
+NCBI_API_KEY = os.environ.get("NCBI_API_KEY")
+# PubMed 只搜尋這一年之後發表的文獻
+PUBMED_SINCE_YEAR = 2024
+# AI 關鍵字與本地預估關鍵字重疊達此比例時，沿用預先搜尋的 PubMed 結果
+SEED_REUSE_OVERLAP = 0.5
+# 本地關鍵字少於此字數 (中文稿件、只有圖片) 時不做預先搜尋
+SEED_MIN_TERMS = 2
+
+# 稿件送進 prompt 的 token 預算 (中英文每 token 字數差很多，以 token 計才準)
+REVIEW_TOKEN_BUDGET = 28_000
+KEYWORD_TOKEN_BUDGET = 1_500
+# 英文約 4 字/token，超過這個字數的頁面不可能進入 prompt，不必再抽取
+MAX_CHARS = REVIEW_TOKEN_BUDGET * 4
+
+IMAGE_EXTS = frozenset({'jpg', 'jpeg', 'png', 'tiff', 'tif'})
+# 每把 Key 每分鐘的請求上限；預設為免費額度，付費 Key 可用環境變數 GEMINI_RPM 調高
+GEMINI_RPM = int(os.environ.get("GEMINI_RPM", "15"))
+# 每次請求最多附幾張圖，超過時分批並行送出
+IMAGE_BATCH_SIZE = 8
+# Gemini 視覺編碼以約 768px 切塊，長邊超過 1568px 只是多傳位元組
+MAX_IMAGE_SIDE = 1568
+# 高度超過 MAX_IMAGE_SIDE 且高寬比超過此值的圖 (整頁掃描) 切成上下數片，相鄰切片重疊 10% 避免切斷文字列
+TILE_ASPECT = 1.3
+TILE_OVERLAP = 0.1
+# 掃描成圖片的正文先以本機 Tesseract 辨識；檔名像圖表的一律交給 Gemini
+OCR_LANGS = "eng+chi_tra"
+OCR_MIN_CHARS = 200
+# 英文字只在前後不接字母時才算 (Fig1、Figure_2 算，config 不算)；中文檔名常用 圖/图/表
+FIGURE_NAME = re.compile(r"(?<![a-z])(?:fig|figure|table|tbl|chart)s?(?![a-z])|[圖图表]", re.IGNORECASE)
 
 # --- 3. 檔案讀取工具 ---
-def get_text_from_pdf(file_obj):
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+# run 內的定位字元與換行，python-docx 也會轉成 \t 與 \n
+RUN_BREAKS = {f"{W_NS}tab": "\t", f"{W_NS}br": "\n", f"{W_NS}cr": "\n"}
+
+@st.cache_resource
+def _fitz_lock():
+    # PyMuPDF 不支援多執行緒同時使用；process_file 在執行緒池中執行，同一時間只讓一份 PDF 進入 MuPDF。
+    # Streamlit 每次 rerun 都重新執行本檔，鎖放在 cache_resource 才是整個程序 (所有使用者) 共用同一把
+    return threading.Lock()
+
+def _get_text_with_fitz(data, max_chars):
+    import fitz  # PyMuPDF
+    with _fitz_lock():
+        doc = fitz.open(stream=data, filetype="pdf")
+        try:
+            parts, total = [], 0
+            for page in doc:
+                text = page.get_text("text")
+                # 掃描頁、純圖頁沒有文字，不留下空行
+                if text.strip():
+                    parts.append(text)
+                    total += len(text)
+                    # 字數已超過 prompt 能用的量，後面的頁面不必再抽
+                    if total >= max_chars: break
+            return "\n".join(parts)
+        finally:
+            doc.close()
+
+def _get_text_with_pypdf(data, max_chars):
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    parts, total = [], 0
+    for page in reader.pages:
+        extract = page.extract_text()
+        if extract:
+            parts.append(extract)
+            total += len(extract)
+            if total >= max_chars: break
+    return "\n".join(parts)
+
+def get_text_from_pdf(file_obj, max_chars=MAX_CHARS):
     try:
-        reader = PdfReader(file_obj)
-        text = ""
-        for page in reader.pages:
-            extract = page.extract_text()
-            if extract: text += extract
-        return text
+        data = file_obj.read()
     except Exception as e:
         return f"[PDF 讀取錯誤: {e}]"
+    try:
+        return _get_text_with_fitz(data, max_chars)
+    except Exception as e:
+        # MuPDF 處理不了的少數損毀檔，改用 pypdf 再試一次
+        try:
+            return _get_text_with_pypdf(data, max_chars)
+        except Exception:
+            return f"[PDF 讀取錯誤: {e}]"
+
+SECTION_HEADER = re.compile(
+    r"^\s*(?:\d+\.?\s*)?(abstract|introduction|background|materials and methods|patients and methods|methods"
+    r"|results|discussion|conclusions?|references)\s*:?\s*$",
+    re.IGNORECASE,
+)
+
+def annotate_lines(text):
+    """
+    每行加上 [L#]，章節標題前加 [Section: ...]。[L#] 是本工具抽取後的行序，不是稿件印刷的行號
+    (PDF 邊欄行號、略過空段落的 DOCX 都對不上)，只供定位，報告引用時一律附上原文句子。
+    """
+    out = []
+    for n, line in enumerate(text.splitlines(), start=1):
+        header = SECTION_HEADER.match(line)
+        if header:
+            out.append(f"[Section: {header.group(1).title()}]")
+        out.append(f"[L{n}] {line}" if line.strip() else "")
+    return "\n".join(out)
 
 def get_text_from_word(file_obj, file_ext):
+    from lxml import etree
     try:
-        doc = Document(file_obj)
-        text = "\n".join([para.text for para in doc.paragraphs])
-        return text
+        # 直接串流 word/document.xml，不建立 python-docx 的完整物件模型
+        # 只取 run 內的 <w:t>/<w:tab>/<w:br>/<w:cr>：itertext 會把功能變數代碼 (w:instrText)
+        # 與追蹤修訂刪除的字 (w:delText) 一併帶進來
+        parts = []
+        with zipfile.ZipFile(file_obj) as z, z.open("word/document.xml") as f:
+            for _, p in etree.iterparse(f, tag=f"{W_NS}p"):
+                # 段落屬性 <w:tabs> 裡的 <w:tab> 是定位點設定，不是內容，只取 run 底下的元素
+                text = "".join(
+                    RUN_BREAKS.get(el.tag, el.text) or ""
+                    for el in p.iter(f"{W_NS}t", *RUN_BREAKS) if el.getparent().tag == f"{W_NS}r"
+                ).strip()
+                # Word 匯出的稿件常有大量空段落，略過才不會佔用行號與 token
+                if text:
+                    parts.append(text)
+                # clear 只清空內容，段落本身仍掛在 <w:body> 下；連同已處理的前面兄弟節點一併移除，
+                # 記憶體才不會隨段落數增加
+                p.clear()
+                while p.getprevious() is not None:
+                    del p.getparent()[0]
+        return "\n".join(parts)
     except Exception as e:
         if "doc" in file_ext and "docx" not in file_ext:
             return "⚠️ [格式提示]: 偵測到舊版 Word (.doc)。建議另存為 .docx。"
@@ -49,128 +171,509 @@ def get_text_from_word(file_obj, file_ext):
             return f"[Word 讀取錯誤: {e}]"
 
 # --- 4. 動態模型偵測 ---
+@st.cache_resource
+def _genai_state():
+    # salt 在程序存活期間固定，快取鍵才會穩定
+    return {"salt": os.urandom(16)}
+
+def content_digest(data):
+    """
+    檔案與文字內容的快取鍵。只用來比對內容是否相同，不需密碼學強度，BLAKE2b 比 SHA-256 快。
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def key_digest(api_key):
+    """
+    快取一律以加鹽的 SHA-256 作為 Key 的代表，原始 Key 不進入快取鍵。
+    """
+    return hashlib.sha256(_genai_state()["salt"] + api_key.encode("utf-8")).hexdigest()
+
+# 每把 Key 的 client、模型與速率 bucket 只保留最近使用的少數幾把，一小時後失效，
+# 伺服器不會一直留著每一把輸入過的 Key
+KEY_CACHE_ENTRIES = 32
+KEY_CACHE_TTL = 3600
+
+@st.cache_resource(max_entries=KEY_CACHE_ENTRIES, ttl=KEY_CACHE_TTL)
+def _clients(digest, _api_key):
+    """
+    每把 Key 各自一組 client。genai.configure 是整個程序共用的全域設定，
+    多位使用者共用同一台伺服器時會互相覆蓋，請求可能帶著別人的 Key 送出。
+    注意：_ClientManager 與下方的 model._client 都是 SDK 內部 API，requirements.txt 因此鎖定 0.8 版。
+    """
+    from google.generativeai.client import _ClientManager
+    manager = _ClientManager()
+    manager.configure(api_key=_api_key)
+    return {
+        "generative": manager.get_default_client("generative"),
+        "model": manager.get_default_client("model"),
+    }
+
+# 同一把 Key 可用的模型在一次使用期間不會變，快取一小時
+@st.cache_data(max_entries=KEY_CACHE_ENTRIES, ttl=KEY_CACHE_TTL, show_spinner=False)
+def _list_models(digest, _api_key):
+    import google.generativeai as genai
+    client = _clients(digest, _api_key)["model"]
+    return [m.name for m in genai.list_models(client=client) if 'generateContent' in m.supported_generation_methods]
+
+@st.cache_resource(max_entries=KEY_CACHE_ENTRIES, ttl=KEY_CACHE_TTL)
+def _get_model(digest, model_name, _api_key):
+    import google.generativeai as genai
+    model = genai.GenerativeModel(model_name)
+    # 建立時就綁定這把 Key 的 client；SDK 只有在 _client 為 None 時才去拿全域預設 client
+    model._client = _clients(digest, _api_key)["generative"]
+    return model
+
+MODEL_PRIORITY = ('flash', '1.5-pro', 'gemini-pro')
+
+class RateLimiter:
+    """
+    Token bucket：每分鐘最多 rpm 次請求，額度還有時不等待。
+    """
+    def __init__(self, rpm):
+        self.rpm = rpm
+        self._tokens = float(rpm)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rpm, self._tokens + (now - self._last) * self.rpm / 60)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return self
+                wait = (1 - self._tokens) * 60 / self.rpm
+            time.sleep(wait)
+
+    def __exit__(self, *exc):
+        return False
+
+class LRUCache:
+    """
+    有上限與存活時間的 LRU 快取，給「一次請求寫入多筆」的情況用：一批圖片一次 Gemini 呼叫、
+    多個 PMID 一次 efetch，結果要逐筆存取；st.cache_data 只能以整個函式呼叫為單位快取。
+    """
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, stored = item
+            if self.ttl is not None and time.monotonic() - stored > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+@st.cache_resource(max_entries=KEY_CACHE_ENTRIES, ttl=KEY_CACHE_TTL)
+def _gemini_limiter(digest):
+    # Gemini 的額度是以 Key 計算，每把 Key 各自一個 bucket，使用者之間不互相拖慢
+    return RateLimiter(GEMINI_RPM)
+
+def generate(model, contents, digest, retries=3, **kwargs):
+    """
+    所有 Gemini 生成呼叫都經過這裡：先取得這把 Key (digest) 的速率額度，遇到 429 以指數退避加抖動重試。
+    """
+    from google.api_core import exceptions as google_exceptions
+    for attempt in range(retries + 1):
+        with _gemini_limiter(digest):
+            try:
+                return model.generate_content(contents, **kwargs)
+            except google_exceptions.ResourceExhausted:
+                if attempt == retries:
+                    raise
+        time.sleep(random.uniform(0.5, 1.5) * 2 ** attempt)
+
 def find_best_model(api_key):
     """
     直接詢問 API 有哪些模型可用，不再瞎猜名稱。
     """
-    genai.configure(api_key=api_key)
     try:
-        available_models = []
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                available_models.append(m.name)
+        available_models = _list_models(key_digest(api_key), api_key)
         
         if not available_models:
             return None, "沒有找到任何支援生成內容的模型 (權限或區域問題)。"
             
-        # 優先順序策略
-        best_model = None
-        # 1. 優先找 Flash (最快)
-        for m in available_models:
-            if 'flash' in m:
-                best_model = m
-                break
-        # 2. 其次找 1.5 Pro
-        if not best_model:
-            for m in available_models:
-                if '1.5-pro' in m:
-                    best_model = m
-                    break
-        # 3. 再不行找 gemini-pro
-        if not best_model:
-            for m in available_models:
-                if 'gemini-pro' in m:
-                    best_model = m
-                    break
-        # 4. 真的都沒有，就拿第一個
-        if not best_model:
-            best_model = available_models[0]
+        # 優先順序策略：Flash (最快) > 1.5 Pro > gemini-pro > 清單第一個
+        # 單次掃描，min 遇到同分時保留清單中較前面的模型
+        def rank(m):
+            return next((i for i, p in enumerate(MODEL_PRIORITY) if p in m), len(MODEL_PRIORITY))
+        best_model = min(available_models, key=rank)
             
         return best_model, None
 
     except Exception as e:
         return None, str(e)
 
-# --- 5. 圖片分析 ---
-def analyze_image_content(image_file, api_key):
-    model_name, error = find_best_model(api_key)
-    if error: return f"[圖片分析失敗: {error}]"
-    
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_name)
+def get_gemini_model(api_key):
+    """
+    偵測模型並建立 GenerativeModel，供多個執行緒共用同一個實例。
+    結果存在 st.session_state，同一把 Key 的後續點擊直接沿用；換 Key 時重新偵測。
+    """
+    digest = key_digest(api_key)
+    if st.session_state.get("model_key") == digest:
+        return st.session_state["model"], None
     
-    try:
-        image = Image.open(image_file)
-        if image.format == 'TIFF':
-            buffered = io.BytesIO()
-            image.save(buffered, format="PNG")
-            image = Image.open(buffered)
+    model_name, error = find_best_model(api_key)
+    if error:
+        return None, error
+    st.session_state["model"] = _get_model(digest, model_name, api_key)
+    st.session_state["model_name"] = model_name
+    st.session_state["model_key"] = digest
+    return st.session_state["model"], None
+
+# --- 5. 圖片分析 ---
+def _encode_image(image):
+    """
+    縮圖並壓縮後回傳 Gemini 的 inline blob，直接送出已編碼的位元組，SDK 不必再解碼/重新編碼一次。
+    """
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+    # 色數少的彩色圖 (折線圖、流程圖) 用 PNG 保持線條清晰，照片類用 JPEG 壓小；
+    # 灰階 (L) 最多只有 256 階，色數判斷不出是不是照片，X 光、CT、MRI 一律走 JPEG
+    buffered = io.BytesIO()
+    if image.mode == "RGB" and image.getcolors(maxcolors=256) is not None:
+        image.save(buffered, format="PNG", optimize=True)
+        mime_type = "image/png"
+    else:
+        image.save(buffered, format="JPEG", quality=85, optimize=True)
+        mime_type = "image/jpeg"
+    return {"mime_type": mime_type, "data": buffered.getvalue()}
+
+def load_image(data):
+    """
+    回傳一張圖的 blob 清單。瘦長的掃描頁切成上下重疊的數片，每片都保有完整解析度，小字才看得清楚。
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        # JPEG 可在解碼時直接縮小 (DCT scaling)，不必先解出整張全解析度像素
+        source.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+        image = source
+        # 醫學 TIFF 常見 16-bit 灰階或 CMYK，先轉成一般 8-bit 模式
+        if image.mode in ("I", "I;16", "I;16B", "I;16L"):
+            image = image.convert("I").point(lambda v: v / 256).convert("L")
+        elif image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+            # 透明背景的圖表直接轉 RGB 會變成整片黑色，先疊到白底上
+            rgba = image.convert("RGBA")
+            image = Image.alpha_composite(Image.new("RGBA", rgba.size, "white"), rgba).convert("RGB")
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
         
-        prompt = "這是醫學論文的附圖。請詳細描述數據、趨勢、圖表標題(如 Figure 1)與關鍵資訊。"
-        response = model.generate_content([prompt, image])
-        return response.text
-    except Exception as e:
-        return f"[圖片分析錯誤: {e}]"
+        # 編碼都在 with 內完成，離開後原圖的解碼緩衝即釋放，送往 Gemini 時只留壓縮後的位元組
+        width, height = image.size
+        # 縮圖本來就不會縮小的圖切片沒有解析度好處，只會多付每張圖的 token
+        if height <= MAX_IMAGE_SIDE or height <= width * TILE_ASPECT:
+            return [_encode_image(image)]
+        step = math.ceil(height / math.ceil(height / (width * TILE_ASPECT)))
+        overlap = int(step * TILE_OVERLAP)
+        return [
+            _encode_image(image.crop((0, max(0, y - overlap), width, min(height, y + step + overlap))))
+            for y in range(0, height, step)
+        ]
 
-# --- 6. PubMed 搜尋 ---
-def search_pubmed(keywords, max_results=5):
+@st.cache_resource
+def _tesseract():
+    """
+    pytesseract 與 tesseract 執行檔都可用時回傳模組，否則回傳 None (只檢查一次)。
+    """
     try:
-        search_term = f"{keywords} AND (2024/01/01[Date - Publication] : 3000[Date - Publication])"
-        handle = Entrez.esearch(db="pubmed", term=search_term, retmax=max_results, sort="date")
-        record = Entrez.read(handle)
-        handle.close()
-        
-        id_list = record["IdList"]
-        if not id_list:
-            return "未找到 2024 年後的最新相關文獻。"
-
-        handle = Entrez.efetch(db="pubmed", id=id_list, rettype="abstract", retmode="text")
-        abstracts = handle.read()
-        handle.close()
-        return abstracts
+        import pytesseract
+        pytesseract.get_tesseract_version()
+        return pytesseract
+    except Exception:
+        return None
+
+def ocr_text(data):
+    """
+    本機 OCR；辨識出的文字夠長且大多是文字 (非雜訊符號) 才回傳，否則回傳 None。
+    """
+    tesseract = _tesseract()
+    if tesseract is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            text = tesseract.image_to_string(image, lang=OCR_LANGS).strip()
+    except Exception:
+        return None
+    letters = sum(c.isalpha() for c in text)
+    if len(text) < OCR_MIN_CHARS or letters < len(text) * 0.6:
+        return None
+    return text
+
+@st.cache_resource
+def _image_desc_cache():
+    """
+    以圖片位元組的 content_digest 為鍵保存描述，修稿時重新上傳同一張圖不必再付一次 Gemini 成本。
+    稿件圖表屬於未發表內容，只保留最近的少量且一小時後失效。
+    """
+    return LRUCache(maxsize=256, ttl=3600)
+
+def _describe_images(datas, model, digest):
+    """
+    回傳 (描述清單, 是否可快取)。數量對不上或出錯時不可快取。
+    """
+    try:
+        images = [load_image(d) for d in datas]
+        prompt = (
+            f"以下依序是醫學論文的 {len(images)} 張附圖。請逐張詳細描述數據、趨勢、圖表標題(如 Figure 1)與關鍵資訊。\n"
+            + ("有些圖被切成由上到下的數片，相鄰切片約重疊 10%，邊界處重複出現的文字只描述一次。\n"
+               if any(len(tiles) > 1 for tiles in images) else "")
+            + f"請回傳長度為 {len(images)} 的 JSON 字串陣列，第 i 個元素是第 i 張圖的描述。"
+        )
+        contents = [prompt]
+        for i, tiles in enumerate(images, start=1):
+            label = f"第 {i} 張圖" if len(tiles) == 1 else f"第 {i} 張圖 (切成 {len(tiles)} 片)"
+            contents += [label, *tiles]
+        # 要求 JSON 輸出，不必再用正規表示式從自由文字拆出每張圖
+        response = generate(model, contents, digest, generation_config={"response_mime_type": "application/json"})
+        text = response.text
     except Exception as e:
-        return f"PubMed API 連線錯誤: {e}"
+        return [f"[圖片分析錯誤: {e}]"] * len(datas), False
+    
+    try:
+        descriptions = [str(d).strip() for d in json.loads(text)]
+    except (ValueError, TypeError):
+        descriptions = []
+    if len(descriptions) != len(datas):
+        # 數量對不上時不硬拆，整段描述放在第一張圖
+        return [text] + ["[見上方合併描述]"] * (len(datas) - 1), False
+    return descriptions, True
 
-# --- 7. 核心 AI 流程 (Prompt 更新) ---
-def run_full_analysis(combined_text, api_key):
+def analyze_images_batch(names, datas, model, keys, digest):
+    """
+    未快取的附圖先試本機 OCR，其餘每 IMAGE_BATCH_SIZE 張合併成一次請求，各批並行送出；
+    datas 為各圖位元組，keys 為其 content_digest，digest 為 API Key 的 key_digest；回傳與輸入順序相同的描述清單。
+    """
+    cache = _image_desc_cache()
+    fresh = {i: desc for i, key in enumerate(keys) if (desc := cache.get(key)) is not None}
+    pending = [i for i in range(len(keys)) if i not in fresh]
     
-    # 步驟 0: 動態尋找模型
-    model_name, error = find_best_model(api_key)
-    if error:
-        return f"Error (模型偵測失敗): {error}"
+    # 非圖表的圖 (掃描的正文頁) 先試本機 OCR，文字夠多就直接採用，不必送 Gemini
+    candidates = [i for i in pending if not FIGURE_NAME.search(names[i])]
+    if candidates and _tesseract() is not None:
+        with ThreadPoolExecutor(max_workers=5) as ex:
+            for i, text in zip(candidates, ex.map(lambda i: ocr_text(datas[i]), candidates)):
+                if text:
+                    fresh[i] = f"[OCR 文字]\n{text}"
+                    cache.set(keys[i], fresh[i])
+        pending = [i for i in pending if i not in fresh]
     
-    st.toast(f"已連線模型: {model_name}")
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_name)
+    if pending and model is None:
+        fresh.update((i, "[圖片分析失敗: 沒有可用的模型]") for i in pending)
+    elif pending:
+        batches = [pending[i:i + IMAGE_BATCH_SIZE] for i in range(0, len(pending), IMAGE_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=5) as ex:
+            results = ex.map(lambda batch: _describe_images([datas[i] for i in batch], model, digest), batches)
+            for batch, (descriptions, cacheable) in zip(batches, results):
+                fresh.update(zip(batch, descriptions))
+                if cacheable:
+                    for i in batch:
+                        cache.set(keys[i], fresh[i])
+    
+    return [fresh[i] for i in range(len(keys))]
 
-    # 步驟 A: 提取關鍵字
-    st.status(f"步驟 1/3: 使用 AI 提取關鍵字...", expanded=True)
-    keyword_prompt = f"請從以下內容提取 3-5 個醫學關鍵字 (MeSH terms)，用英文空格分隔：\n{combined_text[:5000]}"
+# --- 6. PubMed 搜尋 ---
+@st.cache_resource
+def _ncbi_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    # 共用連線池：esearch 之後的 efetch 與下一次搜尋都不必重做 TCP/TLS 握手
+    # NCBI 偶爾回 429/5xx，由 adapter 以退避自動重試
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retry))
+    return session
+
+def _eutils(endpoint, **params):
+    """
+    直接呼叫 NCBI E-utilities，省去 Biopython 的 XML/DTD 解析。
+    """
+    params.update(tool="medical-review-ai", email=email_address)
+    if NCBI_API_KEY:
+        params["api_key"] = NCBI_API_KEY
+    resp = _ncbi_session().get(f"{EUTILS_BASE}{endpoint}", params=params, timeout=30)
+    resp.raise_for_status()
+    return resp.content
+
+def _itertext(elem):
+    return " ".join("".join(elem.itertext()).split()) if elem is not None else ""
+
+def _format_articles(xml_bytes):
+    """
+    串流解析 efetch XML，每篇只保留 PMID/年份/期刊/標題/第一作者/摘要，減少送進 prompt 的 token。
+    回傳 {PMID: 文字區塊}。
+    """
+    blocks = {}
+    for _, elem in ET.iterparse(io.BytesIO(xml_bytes), events=("end",)):
+        if elem.tag != "PubmedArticle":
+            continue
+        pub_date = elem.find(".//JournalIssue/PubDate")
+        year = pub_date.findtext("Year") or (pub_date.findtext("MedlineDate") or "")[:4] if pub_date is not None else ""
+        journal = elem.findtext(".//Journal/ISOAbbreviation") or elem.findtext(".//Journal/Title", "")
+        author = elem.find(".//AuthorList/Author")
+        first_author = f"{author.findtext('LastName', '')} {author.findtext('Initials', '')}".strip() if author is not None else ""
+        abstract = " ".join(
+            f"{t.get('Label')}: {_itertext(t)}" if t.get("Label") else _itertext(t)
+            for t in elem.iterfind(".//Abstract/AbstractText")
+        )
+        pmid = elem.findtext(".//MedlineCitation/PMID", "")
+        blocks[pmid] = (
+            f"PMID: {pmid} | {year} | {journal}\n"
+            f"Title: {_itertext(elem.find('.//ArticleTitle'))}\n"
+            f"First author: {first_author}\n"
+            f"Abstract: {abstract or '(no abstract)'}"
+        )
+        elem.clear()
+    return blocks
+
+@st.cache_resource
+def _abstract_cache():
+    """
+    PMID 一經發布內容就不會變，摘要以 PMID 為鍵跨查詢共用；不同關鍵字搜到同一篇時不必再 efetch。
+    """
+    return LRUCache(maxsize=4096, ttl=86400)
+
+# 查詢條件只取近年的最新文獻，一天內結果變動不大
+@st.cache_data(ttl=86400, show_spinner=False)
+def _search_pubmed_cached(query_key, max_results, since_year, _keywords):
+    """
+    以 (正規化關鍵字, 篇數, 起始年) 為快取鍵；例外不會被快取，連線失敗下次仍會重試。
+    """
+    search_term = f"{_keywords} AND ({since_year}/01/01[Date - Publication] : 3000[Date - Publication])"
+    pmids = json.loads(_eutils(
+        "esearch.fcgi", db="pubmed", term=search_term, retmax=max_results,
+        sort="date", retmode="json"
+    ))["esearchresult"]["idlist"]
     
+    if not pmids:
+        return f"未找到 {since_year} 年後的最新相關文獻。"
+
+    # 只 efetch 快取中沒有的 PMID，並合併成一次請求
+    cache = _abstract_cache()
+    blocks = {pmid: block for pmid in pmids if (block := cache.get(pmid)) is not None}
+    missing = [pmid for pmid in pmids if pmid not in blocks]
+    if missing:
+        fetched = _format_articles(_eutils(
+            "efetch.fcgi", db="pubmed", id=",".join(missing), retmode="xml"
+        ))
+        for pmid, block in fetched.items():
+            cache.set(pmid, block)
+        blocks.update(fetched)
+    return "\n\n".join(blocks[pmid] for pmid in pmids if pmid in blocks)
+
+def search_pubmed(keywords, max_results=5, since_year=PUBMED_SINCE_YEAR):
+    # Gemini 每次回傳的關鍵字順序、大小寫、空白可能不同，正規化後才能命中快取
+    query_key = " ".join(sorted(keywords.lower().split()))
+    # 空的查詢只剩日期條件，依日期排序會搜到最新但無關的文獻
+    if not query_key:
+        return f"未找到 {since_year} 年後的最新相關文獻。"
     try:
-        kw_resp = model.generate_content(keyword_prompt)
-        keywords = kw_resp.text.strip()
-        st.success(f"關鍵字: {keywords}")
+        return _search_pubmed_cached(query_key, max_results, since_year, keywords)
     except Exception as e:
-        return f"Error (關鍵字階段 - {model_name}): {str(e)}"
+        return f"PubMed API 連線錯誤: {e}"
 
-    # 步驟 B: PubMed
-    st.status("步驟 2/3: 搜尋 PubMed...", expanded=True)
-    pubmed_data = search_pubmed(keywords)
-    
-    # 步驟 C: 雙語審稿 (Prompt 核心修改)
-    st.status("步驟 3/3: 生成雙語且精確引用的審稿報告...", expanded=True)
-    
-    review_prompt = f"""
+# 本地粗選關鍵字時略過的常見英文字 (含論文常用套語)
+_STOPWORDS = frozenset("""
+about above after again against among because before being below between
+could during having other should their there these those through under
+until where which while would study studies patients patient results
+method methods conclusion conclusions background objective however table
+figure using based within without compared group groups total analysis
+section abstract introduction materials discussion references keywords
+hazard ratio ratios confidence interval intervals median follow-up mean
+standard deviation significant significantly statistical statistically
+p-value versus respectively increased decreased higher lower years months
+baseline participants included outcome outcomes reported associated
+""".split())
+
+# annotate_lines 加上的 [L#]、[Section: ...] 與檔名分隔行不是稿件內容
+_MARKERS = re.compile(r"\[L\d+\]|\[Section: [^\]]*\]|^--- File: .* ---$", re.MULTILINE)
+
+def local_keywords(text, k=4, min_count=3):
+    """
+    不呼叫 AI，以字頻挑出英文關鍵字 (重複出現的二字詞組優先，如 breast cancer)。
+    回傳 (關鍵字, 是否足夠可靠)；至少 3 個詞組各出現 min_count 次以上才算可靠。
+    """
+    text = _MARKERS.sub(" ", text)
+    # 標點也當成 token，詞組才不會跨句或跨過逗號
+    tokens = [w.lower() for w in re.findall(r"[A-Za-z][A-Za-z-]*|[.,;:()\n]", text)]
+    valid = [len(w) >= 5 and w not in _STOPWORDS for w in tokens]
+    counts = Counter(w for w, ok in zip(tokens, valid) if ok)
+    # 只有緊鄰且都不是停用字的兩個字才算詞組，避免跨過 of/the 湊出不存在的詞
+    bigrams = Counter(
+        f"{tokens[i]} {tokens[i + 1]}"
+        for i in range(len(tokens) - 1) if valid[i] and valid[i + 1]
+    )
+    picked, covered = [], set()
+    for b, n in bigrams.most_common():
+        if n < 2 or len(picked) == k:
+            break
+        if covered.isdisjoint(b.split()):
+            picked.append(b)
+            covered.update(b.split())
+    picked += [w for w, _ in counts.most_common(k + len(covered)) if w not in covered][:k - len(picked)]
+    confident = sum(1 for b in picked if bigrams.get(b, 0) >= min_count) >= 3
+    return " ".join(picked), confident
+
+def keywords_overlap(a, b):
+    """
+    兩組關鍵字的 Jaccard 相似度 (以小寫單字計)，用來判斷預先搜尋是否已足夠。
+    """
+    sa, sb = set(a.lower().split()), set(b.lower().split())
+    return len(sa & sb) / len(sa | sb) if sa | sb else 0.0
+
+def pubmed_found(result):
+    """
+    search_pubmed 的結果是否含有文獻 (而不是「未找到」或連線錯誤訊息)。
+    """
+    return bool(result) and not result.startswith(("未找到", "PubMed API"))
+
+def merge_pubmed(refined, seed):
+    """
+    以 AI 關鍵字的結果為主，預先搜尋找到的其他文獻附在後面；兩邊都搜到的 PMID 只放一次。
+    """
+    blocks = {}
+    for result in (refined, seed):
+        if pubmed_found(result):
+            # 每篇以空行分隔，第一段是 "PMID: 123"
+            for block in result.split("\n\n"):
+                blocks.setdefault(block.split(" | ", 1)[0], block)
+    return "\n\n".join(blocks.values()) if blocks else refined
+
+# --- 7. 核心 AI 流程 (Prompt 更新) ---
+# Prompt 模板在載入時建立一次；safe_substitute 遇到文中的 $ (如 LaTeX) 也不會出錯
+KEYWORD_PROMPT = Template(
+    "請從以下內容提取 3-5 個英文醫學關鍵字 (MeSH terms)。"
+    "只回傳 JSON：{\"keywords\": [\"...\"]}\n$paper"
+)
+
+REVIEW_PROMPT = Template("""
     You are a senior Medical Journal Reviewer.
     Your task is to review the provided manuscript based on the latest literature (provided below).
 
     【INPUT DATA】
-    1. Manuscript Content: 
-    {combined_text[:30000]}
+    1. Manuscript Content ([Section: ...] marks section headings; each line is prefixed with an [L#] extraction reference.
+       [L#] is this tool's own per-file line index, NOT the manuscript's printed line numbers, which may also appear in the text):
+    $paper
     
-    2. Latest PubMed Literature (2024-Present):
-    {pubmed_data}
+    2. Latest PubMed Literature ($since_year-Present):
+    $pubmed
 
     【REQUIREMENTS】
     Please generate the output in **TWO PARTS**.
@@ -182,8 +685,8 @@ def run_full_analysis(combined_text, api_key):
       1. **整體評價 (Overview)**: Brief summary of value.
       2. **文獻對照 (Reality Check)**: Compare with the PubMed data provided. Is it outdated?
       3. **待釐清問題 (Specific Queries)**: 3-5 sharp points.
-         - **CRITICAL**: You MUST cite the location for every query.
-         - Format: **[Section Name, Line Number OR Quote]** (e.g., [Methods, Line 125] or [Introduction, "The patient was..."]).
+         - **CRITICAL**: You MUST cite the location for every query with the section and a short verbatim quote.
+         - Format: **[Section Name, "Quote", L#]** (e.g., [Methods, "Patients were enrolled between...", L125]). Never give an [L#] without its quote.
       4. **最終判決 (Recommendation)**: **Accept / Minor Revision / Major Revision / Reject** (Bold this).
 
     ---
@@ -194,18 +697,130 @@ def run_full_analysis(combined_text, api_key):
       1. **General Comments**: Very brief (2-3 sentences).
       2. **Specific Comments & Queries**:
          - Numbered list.
-         - **CRITICAL**: Use the same location citation format: **[Section, Line X / Quote]**.
-         - Example: "In the **[Methods]** section (Line 45), you mentioned X, but Table 1 shows Y. Please clarify."
+         - **CRITICAL**: Cite every comment as **[Section, "Quote"]**. Do NOT cite [L#] references here; the authors cannot see them.
+         - Example: "In the **[Methods]** section ("we enrolled 120 patients"), you mentioned X, but Table 1 shows Y. Please clarify."
     
+    """)
+
+@st.cache_data(show_spinner=False)
+def extract_keywords(text_digest, model_name, _model, _text, _digest):
+    """
+    以 content_digest(稿件前段) 與模型名稱為快取鍵，重跑同一份稿件時不再呼叫 Gemini。
+    """
+    keyword_prompt = KEYWORD_PROMPT.safe_substitute(paper=_text)
+    # JSON 輸出避免模型在關鍵字前後加上說明文字，污染 PubMed 查詢
+    text = generate(_model, keyword_prompt, _digest, generation_config={"response_mime_type": "application/json"}).text
+    try:
+        keywords = json.loads(text)["keywords"]
+    except (ValueError, KeyError, TypeError):
+        return text.strip()
+    # 模型偶爾回傳整串字串而不是陣列，直接 join 會把字串拆成單一字元
+    if isinstance(keywords, list):
+        return " ".join(str(k).strip() for k in keywords)
+    return str(keywords).strip()
+
+@st.cache_data(show_spinner=False)
+def _count_tokens(text_digest, model_name, _model, _text):
+    """
+    以 content_digest(全文) 與模型名稱為快取鍵，同一份稿件重跑時不必再呼叫 count_tokens。
     """
+    return _model.count_tokens(_text).total_tokens
+
+def fit_to_tokens(model, text, budgets):
+    """
+    依各 token 預算切出文字前段。只呼叫一次 count_tokens，以平均每 token 字數換算切點。
+    """
+    try:
+        total = _count_tokens(content_digest(text), model.model_name, model, text)
+    except Exception:
+        # 算不出 token 時退回保守的字數切法 (以中文 1 字/token 計)
+        return [text[:budget] for budget in budgets]
+    chars_per_token = len(text) / max(total, 1)
+    return [text[:int(budget * chars_per_token)] for budget in budgets]
+
+def run_full_analysis(combined_text, api_key):
     
+    # 步驟 0: 動態尋找模型
+    model, error = get_gemini_model(api_key)
+    if error:
+        return f"Error (模型偵測失敗): {error}"
+    
+    model_name = st.session_state["model_name"]
+    digest = st.session_state["model_key"]
+    st.toast(f"已連線模型: {model_name}")
+
+    # 步驟 A: 提取關鍵字 (同時用本地關鍵字預先搜尋 PubMed)
+    st.status(f"步驟 1/3: 使用 AI 提取關鍵字...", expanded=True)
+    review_text, kw_text = fit_to_tokens(model, combined_text, (REVIEW_TOKEN_BUDGET, KEYWORD_TOKEN_BUDGET))
+    
+    seed_keywords, confident = local_keywords(review_text[:20000])
+    if len(seed_keywords.split()) < SEED_MIN_TERMS:
+        seed_keywords, confident = "", False
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        seed_future = ex.submit(search_pubmed, seed_keywords)
+        # 稿件中有多個反覆出現的詞組時，本地關鍵字已足夠，省下一次 Gemini 呼叫；
+        # 但本地關鍵字搜不到文獻時，仍交給 Gemini 重新提取
+        if confident and pubmed_found(seed_future.result()):
+            keywords = seed_keywords
+        else:
+            try:
+                keywords = extract_keywords(content_digest(kw_text), model_name, model, kw_text, digest)
+            except Exception as e:
+                return f"Error (關鍵字階段 - {model_name}): {str(e)}"
+        st.success(f"關鍵字: {keywords}")
+
+        # 步驟 B: PubMed
+        st.status("步驟 2/3: 搜尋 PubMed...", expanded=True)
+        # AI 關鍵字與預先搜尋的字詞大致相同時直接沿用，省下第二次 PubMed 往返
+        if keywords_overlap(keywords, seed_keywords) >= SEED_REUSE_OVERLAP and pubmed_found(seed_future.result()):
+            pubmed_data = seed_future.result()
+        else:
+            pubmed_data = merge_pubmed(search_pubmed(keywords), seed_future.result())
+    
+    # 步驟 C: 雙語審稿 (Prompt 核心修改)
+    st.status("步驟 3/3: 生成雙語且精確引用的審稿報告...", expanded=True)
+    
+    review_prompt = REVIEW_PROMPT.safe_substitute(paper=review_text, pubmed=pubmed_data, since_year=PUBMED_SINCE_YEAR)
+    
+    # 串流輸出：第一段文字產生就開始顯示，不必等整份報告
+    st.divider()
     try:
-        final_resp = model.generate_content(review_prompt)
-        return final_resp.text
+        response = generate(model, review_prompt, digest, stream=True)
+        return st.write_stream(chunk.text for chunk in response)
     except Exception as e:
         return f"Error (生成報告階段 - {model_name}): {str(e)}"
 
-# --- 8. 主介面 ---
+# --- 8. 單檔讀取 (於背景執行緒執行，不可呼叫 st.* 介面元件；全域的 st.cache_data 可用) ---
+def file_ext(name):
+    return PurePath(name).suffix.lower().lstrip('.')
+
+# 副檔名 -> 文字抽取函式
+TEXT_EXTRACTORS = {
+    'pdf': lambda file, ext: get_text_from_pdf(file),
+    'docx': get_text_from_word,
+    'doc': get_text_from_word,
+}
+
+# 稿件是未發表的機密內容，只保留最近幾份且一小時後失效，不在伺服器上長期留存
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def _extract_text(digest, ext, _data):
+    """
+    以 (檔案 content_digest, 副檔名) 為快取鍵，重跑分析時同一份檔案不必重新解析。
+    data 每次都包成新的 BytesIO，不共用上傳物件的讀取位置。
+    """
+    extractor = TEXT_EXTRACTORS.get(ext)
+    return annotate_lines(extractor(io.BytesIO(_data), ext)) if extractor else ""
+
+def process_file(idx, name, data, digest):
+    ext = file_ext(name)
+    fragment = f"\n\n--- File: {name} ---\n"
+    try:
+        text = _extract_text(digest, ext, data)
+    except Exception as e:
+        return idx, fragment, f"讀取檔案 {name} 時發生小錯誤: {e}"
+    return idx, fragment + text, None
+
+# --- 9. 主介面 ---
 st.title("🩺 AI 醫學期刊審稿助手 (雙語版)")
 st.markdown("支援 PDF, Word, 圖檔。**含中英雙語報告與精確行號/引用定位。**")
 
@@ -215,27 +830,62 @@ uploaded_files = st.file_uploader(
     accept_multiple_files=True
 )
 
+# 輸入 Key 後先預熱模型清單快取，按下分析時不必再等 list_models；
+# 每把 Key 只預熱一次，無效或被停用的 Key 才不會在每次操作介面時都送出一次 list_models
+if gemini_api_key and st.session_state.get("prewarmed_key") != key_digest(gemini_api_key):
+    st.session_state["prewarmed_key"] = key_digest(gemini_api_key)
+    find_best_model(gemini_api_key)
+
 if uploaded_files and gemini_api_key:
     if st.button("開始整合分析", type="primary"):
-        combined_text = ""
         progress = st.progress(0)
         
-        for i, file in enumerate(uploaded_files):
-            ext = file.name.split('.')[-1].lower()
-            combined_text += f"\n\n--- File: {file.name} ---\n"
-            
-            try:
-                if ext == 'pdf':
-                    combined_text += get_text_from_pdf(file)
-                elif ext in ['docx', 'doc']:
-                    combined_text += get_text_from_word(file, ext)
-                elif ext in ['jpg', 'jpeg', 'png', 'tiff', 'tif']:
-                    combined_text += f"\n[圖表內容 - {file.name}]: {analyze_image_content(file, gemini_api_key)}\n"
-                    time.sleep(1)
-            except Exception as e:
-                st.warning(f"讀取檔案 {file.name} 時發生小錯誤: {e}")
-            
-            progress.progress((i + 1) / len(uploaded_files))
+        # 每個檔案只取一次位元組，之後的雜湊、解析與執行緒都用這份
+        datas = [f.getvalue() for f in uploaded_files]
+        names = [f.name for f in uploaded_files]
+        
+        # 內容完全相同的檔案只處理第一份
+        digests = [content_digest(d) for d in datas]
+        first_seen = {}
+        for i, digest in enumerate(digests):
+            first_seen.setdefault(digest, i)
+        
+        fragments = [""] * len(names)
+        unique = []
+        for i, name in enumerate(names):
+            if first_seen[digests[i]] != i:
+                fragments[i] = f"\n\n--- File: {name} ---\n[與 {names[first_seen[digests[i]]]} 內容相同，已略過]\n"
+            else:
+                unique.append(i)
+        
+        # 圖片延後到最後一次送出，文字檔交給執行緒池
+        image_idx = [i for i in unique if file_ext(names[i]) in IMAGE_EXTS]
+        text_idx = [i for i in unique if i not in image_idx]
+        
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            futures = [ex.submit(process_file, i, names[i], datas[i], digests[i]) for i in text_idx]
+            for done, future in enumerate(as_completed(futures), start=1):
+                idx, fragment, warning = future.result()
+                fragments[idx] = fragment
+                if warning:
+                    st.warning(warning)
+                progress.progress(done / len(names))
+        
+        if image_idx:
+            vision_model, error = get_gemini_model(gemini_api_key)
+            if error:
+                st.warning(f"圖片分析模型無法使用: {error}")
+            descriptions = analyze_images_batch(
+                [names[i] for i in image_idx], [datas[i] for i in image_idx], vision_model,
+                [digests[i] for i in image_idx], key_digest(gemini_api_key)
+            )
+            for idx, desc in zip(image_idx, descriptions):
+                name = names[idx]
+                fragments[idx] = f"\n\n--- File: {name} ---\n\n[圖表內容 - {name}]: {desc}\n"
+        progress.progress(1.0)
+        
+        # 依原始上傳順序組合
+        combined_text = "".join(fragments)
             
         result = run_full_analysis(combined_text, gemini_api_key)
         
@@ -248,8 +898,7 @@ if uploaded_files and gemini_api_key:
                 st.error("🚨 您的 API Key 已被 Google 停用 (Leaked)。請建立一把新的 Key 並重新輸入。")
                 
         elif result:
-            st.divider()
-            st.markdown(result) # 直接顯示包含中英文的完整報告
+            # 報告已在生成時串流顯示，這裡只提供下載
             st.download_button("下載完整報告 (.txt)", result, "review_report.txt")
 
 elif not gemini_api_key:
@@ -9,19 +9,8 @@ print(f"正在測試 API Key: {api_key[:5]}... (隱藏後碼)")
 try:
     genai.configure(api_key=api_key)
     
-    # 1. 測試列出模型 (確認權限)
-    print("\n[測試 1] 正在列出可用模型...")
-    models = [m.name for m in genai.list_models()]
-    if not models:
-        print("❌ 錯誤：無法取得模型清單。請檢查 API Key 是否正確。")
-    else:
-        print(f"✅ 成功連線！您的帳號可用模型包含：")
-        for m in models:
-            if 'flash' in m or 'pro' in m:
-                print(f"   - {m}")
-
-    # 2. 測試生成文字 (確認功能)
-    print("\n[測試 2] 正在測試 gemini-1.5-flash 模型生成文字...")
+    # 直接以一次生成測試驗證 Key、網路與模型端點，不必先列出所有模型
+    print("\n[測試] 正在測試 gemini-1.5-flash 模型生成文字...")
     model = genai.GenerativeModel('gemini-1.5-flash')
     response = model.generate_content("Hello, simply reply 'OK'.")
     print(f"✅ 模型回應：{response.text.strip()}")
@@ -34,6 +23,14 @@ except Exception as e:
     print("------------------------------------------------")
     if "404" in str(e):
         print("💡 推測原因：找不到模型。請確認您已執行 `pip install -U google-generativeai` 更新套件。")
+        # 只有找不到模型時才列出可用模型，協助改用正確名稱
+        try:
+            names = [m.name for m in genai.list_models() if 'flash' in m.name or 'pro' in m.name]
+            print("   您的帳號可用模型包含：")
+            for name in names:
+                print(f"   - {name}")
+        except Exception:
+            pass
     elif "400" in str(e) or "API key not valid" in str(e):
         print("💡 推測原因：API Key 無效。請重新複製，確保沒有複製到多餘的空白鍵。")
     elif "403" in str(e):